@@ -1,12 +1,13 @@
-import hashlib
+import enum
 import itertools
 import json
 import os
+import selectors
 import socket
 import struct
 import sys
-import threading
 import time
+import zlib
 from functools import wraps
 from typing import Any, Optional
 
@@ -14,6 +15,18 @@ SERVER_ADDR = (sys.argv[1], int(sys.argv[2]))
 DATA_FOLDER = "client_data"
 CHUNK_SIZE = 16384  # 16KiB
 REFRESH_TIME = 5  # Check input file every 5 seconds
+PROGRESS_TIME = 0.1  # Redraw the progress bar at most every 100 milliseconds
+INITIAL_TIMEOUT = 1.0  # Seconds to wait for a chunk before requesting it again, until the RTT is measured
+MIN_TIMEOUT = 0.01
+MAX_TIMEOUT = 1.0
+ATTEMPTS = 5  # Requests per chunk before giving up
+WINDOW = 32  # Chunks in flight per part
+FEC_GROUP = 8  # Chunks covered by one parity packet
+HEADER = struct.Struct("!IQ")  # Packet header: checksum, offset
+PARITY = 1 << 63  # Set in the header offset of parity packets
+GET_REQUEST = struct.Struct("!BQI")  # Op.GET, offset, size
+PAR_REQUEST = struct.Struct("!BQIQ")  # Op.PAR, offset, size, length
+RECV_BUF = 2 * WINDOW * (HEADER.size + CHUNK_SIZE)  # Room for a full window of replies per socket
 
 BASE_10_UNITS = (
 	(pow(1000, 0), "B"),  # Byte
@@ -31,6 +44,19 @@ BASE_2_UNITS = (
 	(pow(1024, 4), "TiB"),  # Tebibyte
 )
 
+# Progress bar of each percentage, and the line they are printed into
+BARS = tuple(f"{'█' * int(progress / 8.3):12}" for progress in range(101))
+PROGRESS_LINE = "\r" + " | ".join(f"Part {i}: {{}}" for i in range(4)) + " | {:4} | {:.2f} KBs"
+
+
+class Op(enum.IntEnum):  # First byte of every client message
+	LIST = 0x01
+	DOWN = 0x02
+	GET = 0x03
+	QUIT = 0x04
+	TERM = 0x05
+	PAR = 0x06
+
 
 def convert_size(size: int, base_10: bool) -> tuple[int | float, str]:
 	"""
@@ -73,7 +99,7 @@ class Client:
 		self.quit()
 
 	def get_file_list(self) -> None:
-		self._sock.sendto("LIST".encode(), SERVER_ADDR)
+		self._sock.sendto(bytes([Op.LIST]), SERVER_ADDR)
 		data, _ = self._sock.recvfrom(4096)
 		self._file_list = {filepath: [file_size, False] for filepath, file_size in json.loads(data.decode()).items()}
 		return None
@@ -87,26 +113,6 @@ class Client:
 		quotient, remainder = divmod(file_size, 4)
 		sizes = [quotient] * 3 + [quotient + remainder]  # Chunk sizes
 		offsets = [0] + list(itertools.accumulate(sizes[:-1]))  # Chunk offsets
-		chunk_paths = [os.path.join(DATA_FOLDER, f"part_{i}") for i in range(4)]  # Downloaded parts
-		# Thread for updating progress bar
-		errors = [False] * 4
-		totals = [0] * 4
-		lock = threading.Lock()
-		threads = [threading.Thread(target=Client._update_progress, args=(sizes, totals, errors, lock))]
-		# Download threads
-		for index, (offset, size, chunk_path) in enumerate(zip(offsets, sizes, chunk_paths)):
-			thread = threading.Thread(target=Client._download, args=(filepath, offset, size, chunk_path, totals, errors, index, lock))
-			threads.append(thread)
-
-		for thread in threads:
-			thread.start()
-
-		for thread in threads:  # Wait for all downloads to finish
-			thread.join()
-
-		if any(errors):
-			print(f"Failed [{filepath}]")
-			return False
 		# Number filename if name collision
 		filename = new_name or os.path.basename(filepath)
 		name, ext = os.path.splitext(filename)
@@ -116,91 +122,201 @@ class Client:
 				break
 			filename = f"{name} ({count}){ext}"
 			count += 1
-		# Merge parts
-		with open(new_filepath, "wb") as file:
-			for chunk_path in chunk_paths:
-				with open(chunk_path, "rb") as chunk_file:
-					file.write(chunk_file.read())
-				os.remove(chunk_path)
+		# Preallocate the file, every part writes its chunks straight into place
+		fd = os.open(new_filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o666)
+		if file_size and hasattr(os, "posix_fallocate"):
+			os.posix_fallocate(fd, 0, file_size)
+		else:
+			os.ftruncate(fd, file_size)
+		# One non-blocking socket per part, all driven by a single selector
+		selector = selectors.DefaultSelector()
+		parts = []
+		for offset, size in zip(offsets, sizes):
+			sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+			sock.setblocking(False)
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUF)
+			sock.sendto(down := bytes([Op.DOWN]) + filepath.encode(), SERVER_ADDR)
+			part = {"sock": sock, "down": down, "offset": offset, "size": size, "total": 0,
+					"chunks": Client._split(offset, size), "next": 0,  # Chunks to request, index of the next one
+					"failed": set(),  # Offsets of chunks out of attempts, parity may still rebuild them
+					"srtt": None, "rttvar": 0.0, "timeout": INITIAL_TIMEOUT,  # Retransmission timer
+					"pending": {},  # Offset of each chunk in flight: (chunk size, time sent, attempts left)
+					"groups": {},  # Parity groups by offset: {"acc": XOR of chunks received, "missing": {offset: size}, "parity"}
+					"fd": fd}
+			selector.register(sock, selectors.EVENT_READ, part)
+			parts.append(part)
+			Client._fill_window(part)
+
+		drawn_at = 0.0
+		while not all(part["total"] == part["size"] for part in parts):
+			# Sleep until a reply arrives or the earliest retransmission is due. Pending chunks are kept in the order
+			# they were sent, so the first one of each part is the oldest
+			deadline = min((next(iter(part["pending"].values()))[1] + part["timeout"] for part in parts if part["pending"]),
+						   default=time.perf_counter() + MAX_TIMEOUT)
+			for key, _ in selector.select(timeout=max(0.0, deadline - time.perf_counter())):
+				Client._receive(key.data)
+			# Request again every chunk whose reply is overdue
+			now = time.perf_counter()
+			for part in parts:
+				timeout = part["timeout"]
+				overdue = []
+				for offset, (_, sent_at, _) in part["pending"].items():
+					if now - sent_at < timeout:
+						break
+					overdue.append(offset)
+				if overdue:  # One timeout event, back off once however many chunks it covers
+					part["timeout"] = min(part["timeout"] * 2, MAX_TIMEOUT)
+				if overdue and not part["total"]:  # Nothing received yet, DOWN may have been lost too
+					part["sock"].sendto(part["down"], SERVER_ADDR)
+				for offset in overdue:
+					Client._retry(part, offset)
+			if any(part["failed"] for part in parts):
+				print("\nServer response timeout!")
+				break
+			if now - drawn_at >= PROGRESS_TIME:
+				Client._update_progress(sizes, [part["total"] for part in parts])
+				drawn_at = now
+
+		for part in parts:
+			selector.unregister(part["sock"])
+			part["sock"].sendto(bytes([Op.QUIT]), SERVER_ADDR)
+			part["sock"].close()
+		selector.close()
+		os.close(fd)
+
+		if any(part["failed"] for part in parts):
+			os.remove(new_filepath)
+			print(f"Failed [{filepath}]")
+			return False
+		Client._update_progress(sizes, sizes)
+		print()
 		print(f"\nCompleted [{filename}]")
 		return True
 
 	@staticmethod
-	def _update_progress(sizes: list, totals: list, errors: list, lock: threading.Lock) -> None:
-		file_size = sum(sizes)
-		while True:
-			with lock:
-				if any(errors):
-					print("\nServer response timeout!")
-					break
-				progresses = [int(total / size * 100) for total, size in zip(totals, sizes)]
-			# Print progress bar
-			progress_bar = " | ".join(
-				"Part {}: {:12}".format(i, f"{'█' * int(progress / 8.3):12}")
-				for i, progress in enumerate(progresses))
-
-			downloaded = sum(totals)
-			print("\r{} | {:4} | {:.2f} KBs".format(progress_bar, f'{int(downloaded / file_size * 100)}%', downloaded), end="")
-
-			if all(progress == 100 for progress in progresses):
-				print()
-				break
-			time.sleep(0.02)
+	def _update_progress(sizes: list, totals: list) -> None:
+		# Print progress bar
+		bars = [BARS[total * 100 // size if size else 100] for total, size in zip(totals, sizes)]
+		file_size, downloaded = sum(sizes), sum(totals)
+		percent = downloaded * 100 // file_size if file_size else 100
+		print(PROGRESS_LINE.format(*bars, f"{percent}%", downloaded), end="")
 		return None
 
 	@staticmethod
-	def _download(filepath: str, offset: int, size: int, chunk_path: str, totals: list, errors: list, index: int,
-				  lock: threading.Lock) -> bool:
-		# Handle downloading a single chunk
-		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-		sock.settimeout(0.05)
-		sock.sendto(f"DOWN {filepath}".encode(), SERVER_ADDR)
-
-		total = 0
-		finished = False
-		chunk_file = open(chunk_path, "wb")
-		while True:
-			# Get chunk from server
-			chunk_size = min(CHUNK_SIZE, size - total)
-			data = Client._try_recv(sock, offset, chunk_size)
-			if data is None:
-				with lock:
-					errors[index] = True
-				break
+	def _split(offset: int, size: int) -> list[tuple[int, int]]:
+		# (offset, chunk size) of every chunk of a part: full chunks, then the tail if any
+		num_full, tail = divmod(size, CHUNK_SIZE)
+		chunks = [(offset + i * CHUNK_SIZE, CHUNK_SIZE) for i in range(num_full)]
+		if tail:
+			chunks.append((offset + num_full * CHUNK_SIZE, tail))
+		return chunks
 
-			sock.sendto(f"ACK {offset}".encode(), SERVER_ADDR)
-			chunk_file.write(data)
+	@staticmethod
+	def _fill_window(part: dict) -> None:
+		# Keep up to WINDOW chunks of a part in flight, and ask for a parity packet after every group
+		chunks, index = part["chunks"], part["next"]
+		while len(part["pending"]) < WINDOW and index < len(chunks):
+			offset, chunk_size = chunks[index]
+			first = chunks[index - index % FEC_GROUP][0]
+			group = part["groups"].setdefault(first, {"acc": 0, "missing": {}, "parity": None})
+			group["missing"][offset] = chunk_size
+			Client._request(part, offset, chunk_size, ATTEMPTS)
+			index += 1
+			if index % FEC_GROUP == 0 or index == len(chunks):  # Group complete
+				part["sock"].sendto(PAR_REQUEST.pack(Op.PAR, first, CHUNK_SIZE, offset + chunk_size - first), SERVER_ADDR)
+		part["next"] = index
+		return None
 
-			total = min(total + chunk_size, size)
-			with lock:  # Update progress
-				totals[index] = total
-			if total == size:  # Download complete
-				finished = True
-				break
-			offset += chunk_size
+	@staticmethod
+	def _request(part: dict, offset: int, chunk_size: int, attempts: int) -> None:
+		# Ask the server for the chunk at offset
+		part["sock"].sendto(GET_REQUEST.pack(Op.GET, offset, chunk_size), SERVER_ADDR)
+		part["pending"][offset] = (chunk_size, time.perf_counter(), attempts)
+		return None
 
-		chunk_file.close()
-		sock.sendto("QUIT".encode(), SERVER_ADDR)
-		sock.close()
-		return finished
+	@staticmethod
+	def _retry(part: dict, offset: int) -> None:
+		# Request a chunk again, or give up on the part
+		chunk_size, _, attempts = part["pending"].pop(offset)
+		if attempts > 1:
+			Client._request(part, offset, chunk_size, attempts - 1)
+		else:
+			part["failed"].add(offset)
+		return None
 
 	@staticmethod
-	def _try_recv(sock: socket.socket, offset: int, chunk_size: int, attempts: int = 5) -> Optional[bytes]:
-		data = None
-		while attempts:
-			sock.sendto(f"GET {offset} {chunk_size}".encode(), SERVER_ADDR)
+	def _update_timeout(part: dict, sample: float) -> None:
+		# Jacobson/Karels RTT estimate, as used by TCP
+		if part["srtt"] is None:
+			part["srtt"], part["rttvar"] = sample, sample / 2
+		else:
+			part["rttvar"] = 0.75 * part["rttvar"] + 0.25 * abs(sample - part["srtt"])
+			part["srtt"] = 0.875 * part["srtt"] + 0.125 * sample
+		part["timeout"] = min(max(part["srtt"] + 4 * part["rttvar"], MIN_TIMEOUT), MAX_TIMEOUT)
+		return None
+
+	@staticmethod
+	def _receive(part: dict) -> None:
+		# Handle every reply queued on a part's socket
+		while True:
 			try:
-				packet, _ = sock.recvfrom(chunk_size + 32)
-			except TimeoutError:
-				attempts -= 1
+				packet, _ = part["sock"].recvfrom(HEADER.size + CHUNK_SIZE)
+			except BlockingIOError:
+				return None
+			if len(packet) < HEADER.size:
+				continue
+			checksum, offset = HEADER.unpack_from(packet)
+			data = memoryview(packet)[HEADER.size:]
+			if offset & PARITY:
+				group = part["groups"].get(offset ^ PARITY)
+				if group is not None and checksum == zlib.crc32(data):  # Parity is best effort, never requested again
+					group["parity"] = int.from_bytes(data, "little")
+					Client._recover(part, offset ^ PARITY)
+				continue
+			request = part["pending"].get(offset)
+			if request is None:  # Late duplicate of a chunk already received
 				continue
 			# Verify packet
-			checksum, data = struct.unpack(f"32s{chunk_size}s", packet)
-			if checksum != hashlib.md5(data).hexdigest().encode():
-				attempts -= 1
+			if len(data) != request[0] or checksum != zlib.crc32(data):
+				Client._retry(part, offset)
 				continue
-			break
-		return data
+
+			_, sent_at, attempts = request
+			if attempts == ATTEMPTS:  # Only time chunks sent once, a reply to a resent chunk is ambiguous
+				Client._update_timeout(part, time.perf_counter() - sent_at)
+			Client._store(part, offset, data)
+			Client._fill_window(part)
+
+	@staticmethod
+	def _store(part: dict, offset: int, data: bytes | memoryview) -> None:
+		# Write a verified chunk and account for it in its parity group
+		part["pending"].pop(offset, None)  # Not pending when rebuilt after its last attempt failed
+		part["failed"].discard(offset)
+		if hasattr(os, "pwrite"):
+			os.pwrite(part["fd"], data, offset)  # Replies may arrive out of order
+		else:  # Windows has no pwrite, seek then write
+			os.lseek(part["fd"], offset, os.SEEK_SET)
+			os.write(part["fd"], data)
+		part["total"] += len(data)
+
+		first = offset - (offset - part["offset"]) % (FEC_GROUP * CHUNK_SIZE)
+		group = part["groups"][first]
+		group["acc"] ^= int.from_bytes(data, "little")
+		del group["missing"][offset]
+		Client._recover(part, first)
+		return None
+
+	@staticmethod
+	def _recover(part: dict, first: int) -> None:
+		# Rebuild the last missing chunk of a group from its parity, instead of waiting to request it again
+		group = part["groups"][first]
+		if not group["missing"]:
+			del part["groups"][first]
+		elif group["parity"] is not None and len(group["missing"]) == 1:
+			offset, chunk_size = next(iter(group["missing"].items()))
+			data = (group["parity"] ^ group["acc"]).to_bytes(CHUNK_SIZE, "little")[:chunk_size]
+			Client._store(part, offset, data)
+		return None
 
 	def run(self) -> None:
 		# Print list of files on server
@@ -212,12 +328,8 @@ class Client:
 		print()
 
 		try:
-			begin_time = 0
 			while True:
-				end_time = time.perf_counter()
-				if end_time - begin_time < REFRESH_TIME:
-					continue
-
+				begin_time = time.perf_counter()
 				print("Check download queue...")
 				with open("input.txt", "r") as file:
 					for line in file:
@@ -236,12 +348,13 @@ class Client:
 
 						if self.download(filepath, file_size):
 							self._file_list[filepath][-1] = True
-				begin_time = end_time
+				# Sleep until the next check instead of spinning
+				time.sleep(max(0.0, REFRESH_TIME - (time.perf_counter() - begin_time)))
 		except KeyboardInterrupt:
 			return None
 
 	def quit(self) -> None:
-		self._sock.sendto("QUIT".encode(), SERVER_ADDR)
+		self._sock.sendto(bytes([Op.QUIT]), SERVER_ADDR)
 		self._sock.close()
 		return None
 
@@ -1,26 +1,152 @@
-import hashlib
+import ctypes
+import enum
 import json
+import mmap
+import multiprocessing
+import multiprocessing.connection
 import os
+import platform
 import socket
 import struct
+import sys
+import zlib
 
 PASSWORD = "admin@1234"
 SERVER_PORT = 12345
 DATA_FOLDER = os.path.join("server_data")
-SEND_BUF = 65536  # 32KiB
-RECV_BUF = 1024  # 1KiB
+# Socket buffers hold bursts of GET requests and replies. Without root, Linux caps them at
+# net.core.rmem_max/wmem_max, raise those with sysctl to get the full size
+SEND_BUF = 4 * 1024 * 1024  # 4MiB
+RECV_BUF = 4 * 1024 * 1024  # 4MiB
+# Linux only, ignore the caps when run as root. Values are the asm-generic ones, other architectures
+# (mips, alpha, parisc, sparc) number them differently and use the capped options
+GENERIC_ARCHS = {"x86_64", "i386", "i686", "aarch64", "arm64", "armv6l", "armv7l", "riscv64", "ppc64", "ppc64le", "s390x", "loongarch64"}
+if sys.platform.startswith("linux") and platform.machine() in GENERIC_ARCHS:
+	SO_SNDBUFFORCE, SO_RCVBUFFORCE = 32, 33
+else:
+	SO_SNDBUFFORCE = SO_RCVBUFFORCE = None
+MSG_SIZE = 1024  # 1KiB, largest client message
+CPUS = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+WORKERS = len(CPUS)  # Server processes sharing the port
+BATCH_SIZE = 32  # Max datagrams received/sent per system call
+MSG_WAITFORONE = 0x10000  # Block only until the first datagram of a batch arrives
+HEADER = struct.Struct("!IQ")  # Packet header: checksum, offset
+PARITY = 1 << 63  # Set in the header offset of parity packets
+MAX_CHUNK = 65507 - HEADER.size  # Largest UDP payload over IPv4
+MAX_PARITY_CHUNKS = 64  # Largest group a single PAR may cover
+GET_REQUEST = struct.Struct("!BQI")  # Op.GET, offset, size
+PAR_REQUEST = struct.Struct("!BQIQ")  # Op.PAR, offset, size, length
+
+
+class Op(enum.IntEnum):  # First byte of every client message
+	LIST = 0x01
+	DOWN = 0x02
+	GET = 0x03
+	QUIT = 0x04
+	TERM = 0x05
+	PAR = 0x06
+
+
+class _IOVec(ctypes.Structure):
+	_fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+	_fields_ = [
+		("msg_name", ctypes.c_void_p),
+		("msg_namelen", ctypes.c_uint32),
+		("msg_iov", ctypes.POINTER(_IOVec)),
+		("msg_iovlen", ctypes.c_size_t),
+		("msg_control", ctypes.c_void_p),
+		("msg_controllen", ctypes.c_size_t),
+		("msg_flags", ctypes.c_int),
+	]
+
+
+class _MMsgHdr(ctypes.Structure):
+	_fields_ = [("msg_hdr", _MsgHdr), ("msg_len", ctypes.c_uint)]
+
+
+class _SockAddrIn(ctypes.Structure):
+	_fields_ = [
+		("sin_family", ctypes.c_ushort),
+		("sin_port", ctypes.c_uint16),  # Network byte order
+		("sin_addr", ctypes.c_ubyte * 4),
+		("sin_zero", ctypes.c_ubyte * 8),
+	]
+
+
+try:  # The mmsghdr layout and MSG_WAITFORONE are Linux's, other platforms fall back to one datagram per call
+	if not sys.platform.startswith("linux"):
+		raise OSError("sendmmsg/recvmmsg bindings are Linux only")
+	_libc = ctypes.CDLL(None, use_errno=True)
+	_sendmmsg, _recvmmsg = _libc.sendmmsg, _libc.recvmmsg
+	_sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+	_recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+	_sendmmsg.restype = _recvmmsg.restype = ctypes.c_int
+except (OSError, TypeError, AttributeError):
+	_sendmmsg = _recvmmsg = None
+
+
+def _raise_errno() -> None:
+	err = ctypes.get_errno()
+	raise OSError(err, os.strerror(err))
 
 
 class Server:
-	def __init__(self):
+	def __init__(self, reuse_port: bool = False):
 		self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # Master socket
+		if reuse_port:  # Several workers bind the same port, the kernel spreads clients across them
+			self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 		self._sock.bind(("192.168.100.24", SERVER_PORT))
-		self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUF)
-		self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUF)
+		self._set_buffer(socket.SO_SNDBUF, SO_SNDBUFFORCE, SEND_BUF)
+		self._set_buffer(socket.SO_RCVBUF, SO_RCVBUFFORCE, RECV_BUF)
 		print("Server is initiated")
 
-		self._clients = {}  # Client address: file descriptor
+		self._clients = {}  # Client address: view of the memory-mapped file
 		self._run = False
+		self._file_list = None  # Cached LIST reply
+		self._file_list_mtime = 0  # Modification time of DATA_FOLDER when the reply was built
+		self._outq = []  # Pending replies: (packet, client address), packet i lives in send buffer i
+		self._sendbufs = [memoryview(bytearray(HEADER.size + MAX_CHUNK)) for _ in range(BATCH_SIZE)]
+		self._sockaddrs = {}  # Client address: packed sockaddr_in for sendmmsg
+		if _recvmmsg is not None:
+			self._init_mmsg()
+
+	def _set_buffer(self, option: int, force_option: int | None, size: int) -> None:
+		if force_option is not None:
+			try:
+				self._sock.setsockopt(socket.SOL_SOCKET, force_option, size)
+				return None
+			except PermissionError:  # Not root, fall back to the capped option
+				pass
+		self._sock.setsockopt(socket.SOL_SOCKET, option, size)
+		return None
+
+	def _init_mmsg(self) -> None:
+		# Preallocate message headers once, the kernel fills/reads them in place on every batch
+		self._recv_bufs = (ctypes.c_char * MSG_SIZE * BATCH_SIZE)()
+		self._recv_names = (_SockAddrIn * BATCH_SIZE)()
+		self._recv_iovs = (_IOVec * BATCH_SIZE)()
+		self._recv_msgs = (_MMsgHdr * BATCH_SIZE)()
+		self._send_iovs = (_IOVec * BATCH_SIZE)()
+		self._send_msgs = (_MMsgHdr * BATCH_SIZE)()
+		self._send_pins = [(ctypes.c_char * len(buf)).from_buffer(buf) for buf in self._sendbufs]  # Fixed addresses
+		for i in range(BATCH_SIZE):
+			self._recv_iovs[i].iov_base = ctypes.addressof(self._recv_bufs[i])
+			self._recv_iovs[i].iov_len = MSG_SIZE
+			hdr = self._recv_msgs[i].msg_hdr
+			hdr.msg_name = ctypes.addressof(self._recv_names[i])
+			hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+			hdr.msg_iov = ctypes.pointer(self._recv_iovs[i])
+			hdr.msg_iovlen = 1
+
+			self._send_iovs[i].iov_base = ctypes.addressof(self._send_pins[i])
+			hdr = self._send_msgs[i].msg_hdr
+			hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)
+			hdr.msg_iov = ctypes.pointer(self._send_iovs[i])
+			hdr.msg_iovlen = 1
+		return None
 
 	def __del__(self):
 		print("Server is closed")
@@ -31,59 +157,175 @@ class Server:
 		self._run = True
 		while self._run:
 			try:
-				msg, addr = self._sock.recvfrom(RECV_BUF)
+				batch = self._recv_batch()
 			except Exception as e:
 				print(f"Exception: {e}")
-			else:
-				self.handle_client(msg, addr)
+				continue
+			for msg, addr in batch:
+				try:  # A bad datagram is skipped, the rest of the batch is still served
+					self.handle_client(msg, addr)
+				except Exception as e:
+					print(f"Exception: {e}")
+			try:
+				self._flush()
+			except Exception as e:
+				print(f"Exception: {e}")
+
+	def _recv_batch(self) -> list[tuple[bytes, tuple]]:
+		# Block for one datagram, then take every other datagram already queued (up to BATCH_SIZE)
+		if _recvmmsg is None:
+			return [self._sock.recvfrom(MSG_SIZE)]
+
+		count = _recvmmsg(self._sock.fileno(), ctypes.addressof(self._recv_msgs), BATCH_SIZE, MSG_WAITFORONE, None)
+		if count < 0:
+			_raise_errno()
+		batch = []
+		for i in range(count):
+			name, hdr = self._recv_names[i], self._recv_msgs[i]
+			addr = (socket.inet_ntoa(bytes(name.sin_addr)), socket.ntohs(name.sin_port))
+			batch.append((ctypes.string_at(self._recv_bufs[i], hdr.msg_len), addr))
+			hdr.msg_hdr.msg_namelen = ctypes.sizeof(_SockAddrIn)  # Reset, the kernel overwrites it
+		return batch
+
+	def _flush(self) -> None:
+		# Send all queued replies with as few system calls as possible
+		try:
+			if _sendmmsg is None:
+				for packet, addr in self._outq:
+					self._sock.sendto(packet, addr)
+				return None
+
+			count = len(self._outq)
+			for i, (packet, addr) in enumerate(self._outq):
+				self._send_iovs[i].iov_len = len(packet)
+				self._send_msgs[i].msg_hdr.msg_name = ctypes.addressof(self._sockaddr(addr))
+			sent = 0
+			while sent < count:  # sendmmsg may send only part of the batch
+				msgs = ctypes.addressof(self._send_msgs) + sent * ctypes.sizeof(_MMsgHdr)
+				result = _sendmmsg(self._sock.fileno(), msgs, count - sent, 0)
+				if result < 0:
+					_raise_errno()
+				sent += result
+		finally:
+			self._outq.clear()
+		return None
+
+	def _queue(self, addr: tuple, offset: int, contents: bytes | memoryview, chunk_size: int) -> None:
+		# Build the packet in place in a preallocated buffer, contents are copied exactly once
+		length = len(contents)
+		packet = self._sendbufs[len(self._outq)]
+		packet[HEADER.size:HEADER.size + length] = contents
+		if length < chunk_size:  # Past the end of file, pad with zeros
+			packet[HEADER.size + length:HEADER.size + chunk_size] = bytes(chunk_size - length)
+		HEADER.pack_into(packet, 0, zlib.crc32(packet[HEADER.size:HEADER.size + chunk_size]), offset)
+		self._outq.append((packet[:HEADER.size + chunk_size], addr))  # Sent in one batch by _flush
+		return None
+
+	def _sockaddr(self, addr: tuple) -> _SockAddrIn:
+		# Packed client address, cached until the client quits
+		sockaddr = self._sockaddrs.get(addr)
+		if sockaddr is None:
+			host, port = addr
+			sockaddr = _SockAddrIn(socket.AF_INET, socket.htons(port))
+			sockaddr.sin_addr[:] = socket.inet_aton(host)
+			self._sockaddrs[addr] = sockaddr
+		return sockaddr
 
 	def handle_client(self, msg: bytes, addr: tuple) -> None:
-		msg_parts = msg.decode().split(' ')
-		match msg_parts[0]:
-			case "LIST":  # Client requests list of files on server side
-				file_list = {}
-				for filename in os.listdir(DATA_FOLDER):
-					filepath = os.path.join(DATA_FOLDER, filename)
-					file_list[filepath] = os.path.getsize(filepath)
-				self._sock.sendto(json.dumps(file_list).encode(), addr)
+		# Messages start with an opcode. Only text arguments are decoded, GET and PAR are fixed-size binary
+		# Empty or malformed messages are ignored
+		if not msg:
+			return None
+		match msg[0]:
+			case Op.LIST:  # Client requests list of files on server side
+				mtime = os.stat(DATA_FOLDER).st_mtime_ns
+				if self._file_list is None or mtime != self._file_list_mtime:  # Files added, removed or renamed
+					file_list = {}
+					with os.scandir(DATA_FOLDER) as entries:
+						for entry in entries:
+							file_list[entry.path] = entry.stat().st_size
+					self._file_list = json.dumps(file_list).encode()
+					self._file_list_mtime = mtime
+				self._sock.sendto(self._file_list, addr)
 				print(f"Client {addr} requested list of files in [{DATA_FOLDER}]")
 
-			case "DOWN":  # Client requests to download a file
+			case Op.DOWN:  # Client requests to download a file
 				# Massage: DOWN {filepath}
-				_, filepath = msg_parts
+				filepath = msg[1:].decode()
 				if os.path.exists(filepath):
-					file = open(filepath, "rb")
-					self._clients[addr] = file  # Register the client to the requested file
+					with open(filepath, "rb") as file:  # The mapping stays valid after the file is closed
+						try:
+							mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+						except ValueError:  # Empty files cannot be mapped
+							mapped = b""
+						else:
+							if hasattr(mmap, "MADV_WILLNEED"):  # Read the file ahead in bulk instead of page by page
+								mapped.madvise(mmap.MADV_WILLNEED)
+					self._clients[addr] = memoryview(mapped)  # Register the client to the requested file
 					print(f"Client {addr} registered to download file [{filepath}]")
 
-			case "GET":  # Client requests a part of the currently registered file
-				# Message: GET {offset} {size}
-				# Send from {offset} to {offset} + {size}. If {size} is -1, send the rest of the file
-				_, offset, size = msg_parts
-				file = self._clients[addr]
-				file.seek(int(offset))  # Move cursor to offset position
+			case Op.GET if len(msg) == GET_REQUEST.size:  # Client requests a part of the currently registered file
+				# Message: GET {offset} {size}, packed as GET_REQUEST
+				# Send from {offset} to {offset} + {size}
+				_, offset, size = GET_REQUEST.unpack(msg)
+				view = self._clients.get(addr)
+				if view is None:  # DOWN was lost, the client sends it again
+					return None
+
+				chunk_size = min(size, MAX_CHUNK)
+				contents = view[offset:offset + chunk_size]  # Served from the page cache, no read syscall
+				self._queue(addr, offset, contents, chunk_size)
+
+			case Op.PAR if len(msg) == PAR_REQUEST.size:  # Client requests the XOR parity of a group of chunks, to rebuild one lost chunk
+				# Message: PAR {offset} {size} {length}, packed as PAR_REQUEST
+				# XOR of the {size} chunks from {offset} to {offset} + {length}, a shorter last chunk is padded with zeros
+				_, offset, size, length = PAR_REQUEST.unpack(msg)
+				view = self._clients.get(addr)
+				if view is None or size == 0:
+					return None
 
-				chunk_size = min(abs(int(size)), SEND_BUF)
-				contents = file.read(chunk_size or -1)
-				checksum = hashlib.md5(contents).hexdigest().encode()
-				packet = struct.pack(f"32s{chunk_size}s", checksum, contents)
-				self._sock.sendto(packet, addr)
+				chunk_size = min(size, MAX_CHUNK)
+				end = min(offset + min(length, MAX_PARITY_CHUNKS * chunk_size), len(view))  # Bytes past the end are zeros
+				parity = 0
+				for start in range(offset, end, chunk_size):
+					parity ^= int.from_bytes(view[start:min(start + chunk_size, end)], "little")
+				self._queue(addr, offset | PARITY, parity.to_bytes(chunk_size, "little"), chunk_size)
 
-			case "QUIT":
+			case Op.QUIT:
 				if self._clients.get(addr) is not None:  # Remove client
-					file = self._clients.pop(addr)
-					file.close()
+					view = self._clients.pop(addr)
+					mapped = view.obj
+					view.release()
+					if isinstance(mapped, mmap.mmap):
+						mapped.close()
+				self._sockaddrs.pop(addr, None)
 				print(f"Client {addr} disconnected!")
 
-			case "TERM":  # Admin terminate command
+			case Op.TERM:  # Admin terminate command
 				# Message: TERMINATE {password}
-				_, password = msg_parts
+				password = msg[1:].decode()
 				if password == PASSWORD:
 					self._run = False
 
 		return None
 
 
-if __name__ == "__main__":
-	server = Server()
+def serve(reuse_port: bool = False, cpu: int | None = None) -> None:
+	if cpu is not None and hasattr(os, "sched_setaffinity"):  # Keep each worker on its own core
+		os.sched_setaffinity(0, {cpu})
+	server = Server(reuse_port)
 	server.run()
+
+
+if __name__ == "__main__":
+	if WORKERS > 1 and hasattr(socket, "SO_REUSEPORT"):
+		# One worker per core. Each client socket hashes to one worker, which keeps its registered file
+		workers = [multiprocessing.Process(target=serve, args=(True, cpu)) for cpu in CPUS]
+		for worker in workers:
+			worker.start()
+		multiprocessing.connection.wait([worker.sentinel for worker in workers])  # TERM reaches a single worker
+		for worker in workers:
+			worker.terminate()
+			worker.join()
+	else:
+		serve()